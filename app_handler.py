@@ -1,7 +1,8 @@
+import os
 from fastapi import FastAPI
 import uvicorn
 from mangum import Mangum
-from src.services import SubmitQueryRequest, answer_extraction
+from src.services import SubmitQueryRequest, answer_extraction, answer_extraction_queued, SQLiteWorkQueue
 
 app = FastAPI()
 handler = Mangum(app)
@@ -13,7 +14,11 @@ def index():
 @app.post("/submit_query")
 async def submit_query_endpoint(request:SubmitQueryRequest):
     """ Endpoint to submit a query for processing."""
-    result_json = await answer_extraction(request)   
+    # hand the pages to the worker processes when a queue is configured
+    if os.environ.get("WORK_QUEUE_PATH"):
+        result_json = await answer_extraction_queued(request, SQLiteWorkQueue())
+    else:
+        result_json = await answer_extraction(request)   
     return result_json
 if __name__ == "__main__":
     # Run this as a server directly.
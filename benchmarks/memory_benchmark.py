@@ -0,0 +1,102 @@
+"""
+Memory benchmark for page handling.
+
+Renders synthetic A4 pdfs of increasing page count at 200 DPI and reports
+the peak RSS of holding every page as a PIL image (the old pipeline) against
+the memory bounded PageStore. Each run happens in a fresh process so the
+peaks do not leak into each other.
+
+Usage:
+    python -m benchmarks.memory_benchmark --pages 10 50 150 --budget-mb 256
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import fitz  # PyMuPDF
+import numpy as np
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_pdf(path, page_count):
+    doc = fitz.open()
+    for page_num in range(page_count):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((72, 72), f"Page {page_num + 1}", fontsize=24)
+        page.draw_rect(fitz.Rect(60, 120, 535, 780), color=(0, 0, 0))
+    doc.save(path)
+    doc.close()
+
+
+def run_images(pdf_path, budget_mb):
+    from src.services.utils import pdf_to_images, crop_bounding_box
+    from src.services.datamodels import BoundingBox, Point
+
+    images = pdf_to_images(pdf_path)
+    shapes = [np.array(image).shape[:2] for image in images]
+    for image, (height, width) in zip(images, shapes):
+        bbox = BoundingBox(p1=Point(x=50, y=240), p2=Point(x=width-200, y=240), p3=Point(x=50, y=height-50), p4=Point(x=width-200, y=height-50))
+        crop_bounding_box(image, bbox).tobytes()
+
+
+def run_page_store(pdf_path, budget_mb):
+    from src.services.page_store import PageStore
+    from src.services.utils import crop_bounding_box
+    from src.services.datamodels import BoundingBox, Point
+
+    with PageStore.from_pdf(pdf_path, memory_budget_mb=budget_mb) as pages:
+        for index in range(len(pages)):
+            height, width = pages.shape(index)
+            bbox = BoundingBox(p1=Point(x=50, y=240), p2=Point(x=width-200, y=240), p3=Point(x=50, y=height-50), p4=Point(x=width-200, y=height-50))
+            crop_bounding_box(pages.get(index), bbox).tobytes()
+            pages.release(index)
+
+
+MODES = {"images": run_images, "page_store": run_page_store}
+
+
+def measure(mode, page_count, budget_mb):
+    """Run a single mode in a child process and return its peak RSS in MB."""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.memory_benchmark", "--child", mode, "--pages", str(page_count), "--budget-mb", str(budget_mb)],
+        check=True, capture_output=True, text=True,
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def child(mode, page_count, budget_mb):
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "bench.pdf")
+        make_pdf(pdf_path, page_count)
+        # import everything up front so the peak only reflects page handling
+        import src.services  # noqa: F401
+        start = peak_rss_mb()
+        MODES[mode](pdf_path, budget_mb)
+        print(peak_rss_mb() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS against page count")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 150])
+    parser.add_argument("--budget-mb", type=float, default=256)
+    parser.add_argument("--child", choices=MODES)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.pages[0], args.budget_mb)
+        return
+
+    print(f"{'pages':>6} {'images (MB)':>12} {'page_store (MB)':>16}")
+    for page_count in args.pages:
+        results = [measure(mode, page_count, args.budget_mb) for mode in MODES]
+        print(f"{page_count:>6} {results[0]:>12.1f} {results[1]:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,5 +7,6 @@ This module provides interfaces for various LLM services.
 from .base import LLMClient
 from .gemini_client import GeminiAsyncClient
 from .molmo_client import MolmoAsyncClient
+from .cassette import Cassette
 
-__all__ = ["LLMClient", "GeminiAsyncClient", "MolmoAsyncClient"]
\ No newline at end of file
+__all__ = ["LLMClient", "GeminiAsyncClient", "MolmoAsyncClient", "Cassette"]
\ No newline at end of file
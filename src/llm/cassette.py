@@ -0,0 +1,121 @@
+"""
+Record/replay of model calls for deterministic profiling.
+
+In record mode every request is sent as usual and its response, together
+with the observed latency, is saved to a cassette file keyed by a hash of
+the request content. In replay mode the responses are served from those
+files without any network access, optionally sleeping for the recorded
+latency so timings stay realistic.
+
+Configure with environment variables:
+    LLM_CASSETTE_MODE    : off (default), record or replay
+    LLM_CASSETTE_DIR     : directory for the cassette files (default "cassettes")
+    LLM_CASSETTE_LATENCY : "true" to play back recorded latencies in replay mode
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Callable, Optional
+from PIL import Image
+
+MODES = {"off", "record", "replay"}
+
+
+def digest_image(image) -> str:
+    """Content hash of a PIL image or encoded image bytes."""
+    if isinstance(image, Image.Image):
+        hasher = hashlib.sha256(f"{image.mode}{image.size}".encode())
+        hasher.update(image.tobytes())
+        return hasher.hexdigest()
+    if isinstance(image, str):
+        image = image.encode()
+    return hashlib.sha256(image).hexdigest()
+
+
+class Cassette:
+    """Records and replays model responses keyed by request content."""
+
+    def __init__(self, mode: str = "off", directory: str = "cassettes", replay_latency: bool = False):
+        """
+        Args:
+        mode : off, record or replay
+        directory : Directory for the cassette files
+        replay_latency : Sleep for the recorded latency when replaying
+        """
+        if mode not in MODES:
+            raise ValueError(f"Cassette mode must be one of {sorted(MODES)}, got '{mode}'")
+        self.mode = mode
+        self.directory = directory
+        self.replay_latency = replay_latency
+
+    @classmethod
+    def from_env(cls) -> "Cassette":
+        return cls(
+            mode=os.environ.get("LLM_CASSETTE_MODE", "off").lower(),
+            directory=os.environ.get("LLM_CASSETTE_DIR", "cassettes"),
+            replay_latency=os.environ.get("LLM_CASSETTE_LATENCY", "false").lower() == "true",
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _path(self, kind: str, request: dict) -> str:
+        key = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.directory, kind, f"{key}.json")
+
+    def _load(self, kind: str, request: dict) -> dict:
+        path = self._path(kind, request)
+        if not os.path.exists(path):
+            raise KeyError(f"No {kind} recording found for request at {path}")
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save(self, kind: str, request: dict, response, latency: float):
+        path = self._path(kind, request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"request": request, "response": response, "latency": latency}, f, indent=2, default=str)
+
+    async def play(self, kind: str, request: dict, call: Callable, record_if: Optional[Callable] = None):
+        """
+        Serve an async call through the cassette.
+
+        Args:
+            kind: Sub directory for the recordings, e.g. "gemini"
+            request: Json serialisable request content, images given as digests
+            call: Coroutine function making the live call, must return json serialisable data
+            record_if: Optional predicate on the response, only matching responses are recorded
+
+        Returns:
+            The live or recorded response
+        """
+        if self.replaying:
+            recording = self._load(kind, request)
+            if self.replay_latency:
+                await asyncio.sleep(recording["latency"])
+            return recording["response"]
+        start = time.perf_counter()
+        response = await call()
+        if self.mode == "record" and (record_if is None or record_if(response)):
+            self._save(kind, request, response, time.perf_counter() - start)
+        return response
+
+    def play_sync(self, kind: str, request: dict, call: Callable, record_if: Optional[Callable] = None):
+        """Blocking version of play for calls made outside the event loop."""
+        if self.replaying:
+            recording = self._load(kind, request)
+            if self.replay_latency:
+                time.sleep(recording["latency"])
+            return recording["response"]
+        start = time.perf_counter()
+        response = call()
+        if self.mode == "record" and (record_if is None or record_if(response)):
+            self._save(kind, request, response, time.perf_counter() - start)
+        return response
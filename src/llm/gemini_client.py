@@ -6,6 +6,7 @@ import os
 from typing import Dict, List, Optional, Union, Any, Generator
 import logging
 from .base import LLMClient
+from .cassette import Cassette, digest_image
 from pydantic import BaseModel
 from google import genai
 from google.genai import types
@@ -37,16 +38,18 @@ class GeminiStructuredResponse(BaseModel):
 class GeminiAsyncClient(LLMClient):
     """Async-capable client for Google's Gemini models."""
 
-    def __init__(self, api_key: Optional[str] = None, model: str = "gemini-2.0-flash"):
+    def __init__(self, api_key: Optional[str] = None, model: str = "gemini-2.0-flash", cassette: Optional[Cassette] = None):
+        self.cassette = cassette or Cassette.from_env()
         api_key = api_key or os.environ.get("GEMINI_API_KEY")
-        if not api_key:
+        # replayed runs never reach the api
+        if not api_key and not self.cassette.replaying:
             raise ValueError(
                 "The API key must be provided either as an argument or via environment variable"
             )
 
         super().__init__()
         self.model = model
-        self.client = genai.Client(api_key=api_key)
+        self.client = genai.Client(api_key=api_key) if api_key else None
 
     async def generate(
         self,
@@ -57,6 +60,31 @@ class GeminiAsyncClient(LLMClient):
         temperature: float = 0.1,
     ) -> GeminiResponse:
         """Async generate text using Gemini."""
+        if not self.cassette.enabled:
+            return await self._generate(user_prompt, image, system_prompt, max_tokens, temperature)
+
+        async def call():
+            return (await self._generate(user_prompt, image, system_prompt, max_tokens, temperature)).model_dump()
+
+        request = {
+            "model": self.model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "image": digest_image(image),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        response = await self.cassette.play("gemini", request, call, record_if=lambda r: r["success"])
+        return GeminiResponse(**response)
+
+    async def _generate(
+        self,
+        user_prompt: str,
+        image,
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 4048,
+        temperature: float = 0.1,
+    ) -> GeminiResponse:
         try:
             # Prepare config
             if self.model in {"gemini-2.0-flash", "gemini-2.5-pro"}:
@@ -126,6 +154,33 @@ class GeminiAsyncClient(LLMClient):
         temperature: float = 0.1,
     ) -> GeminiStructuredResponse:
         """Async structured response generation."""
+        if not self.cassette.enabled:
+            return await self._generate_structured_response(user_prompt, structure, image, system_prompt, max_tokens, temperature)
+
+        async def call():
+            return (await self._generate_structured_response(user_prompt, structure, image, system_prompt, max_tokens, temperature)).model_dump()
+
+        request = {
+            "model": self.model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "structure": structure,
+            "image": digest_image(image),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        response = await self.cassette.play("gemini_structured", request, call, record_if=lambda r: r["success"])
+        return GeminiStructuredResponse(**response)
+
+    async def _generate_structured_response(
+        self,
+        user_prompt: str,
+        structure,
+        image,
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 4048,
+        temperature: float = 0.1,
+    ) -> GeminiStructuredResponse:
         try:
             if self.model == "gemini-2.0-flash":
                 model_config = types.GenerateContentConfig(
@@ -2,10 +2,14 @@
 Note: This is a standalone class and doesnot inherit from class in base.py
 """
 import asyncio
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import os 
 import requests 
 import json
+import base64
+from io import BytesIO
+from PIL import Image
+from .cassette import Cassette, digest_image
 import regex as re
 from pydantic import BaseModel
 from dotenv import load_dotenv
@@ -25,32 +29,66 @@ class BoundingBox(BaseModel):
     p4: Point
 
 class MolmoResponse(BaseModel):
-    bbox: List[BoundingBox]
+    # points as (x, y) percentages of the image, in model output order
+    points: List[Tuple[float, float]] = []
+    image_shape: Tuple[int, int]
 
-def get_coords(output_string, image_shape):
+    @property
+    def bbox(self) -> List[BoundingBox]:
+        """Per page bounding boxes. The pipeline works on a BoxTable built from the points instead."""
+        return extrapolte_cords(scale_points(self.points, self.image_shape), self.image_shape)
+
+def encode_image(image: Image.Image, max_size: int, quality: int = 90) -> str:
     """
-    Function to get x, y coordinates given Molmo model outputs.
+    Downscale an image so its longest side is at most max_size and return it as base64 JPEG.
+    The aspect ratio is kept, so Molmo's percentage points map back onto the original page.
+    """
+    if max(image.size) > max_size:
+        image = image.copy()
+        image.thumbnail((max_size, max_size), Image.BILINEAR)
+    image_io = BytesIO()
+    image.save(image_io, format='JPEG', quality=quality)
+    return base64.b64encode(image_io.getvalue()).decode("ascii")
+
+def parse_points(output_string):
+    """
+    Function to get the points of a Molmo model output.
     :param output_string: Output from the Molmo model.
-    :param image: Image in PIL format.
     Returns:
-        coordinates: Coordinates in format of [(x, y), (x, y)]
+        points: (x, y) percentages of the image size, in output order
     """
-    h, w = image_shape
-    
     if 'points' in output_string:
         matches = re.findall(r'(x\d+)="([\d.]+)" (y\d+)="([\d.]+)"', output_string)
-        coordinates = [(int(float(x_val)/100*w), int(float(y_val)/100*h)-50) for _, x_val, _, y_val in matches]
-    else:
-        match = re.search(r'x="([\d.]+)" y="([\d.]+)"', output_string)
-        if match:
-            coordinates = [(int(float(match.group(1))/100*w), int(float(match.group(2))/100*h)-50)]
-        else:
-            coordinates = None
-    if coordinates:
-        coordinates.sort(key=lambda xy: xy[1])
+        return [(float(x_val), float(y_val)) for _, x_val, _, y_val in matches]
+    match = re.search(r'x="([\d.]+)" y="([\d.]+)"', output_string)
+    if match:
+        return [(float(match.group(1)), float(match.group(2)))]
+    return []
+
+def scale_points(points, image_shape):
+    """
+    Scale percentage points to pixel coordinates sorted top to bottom, or None if there are no points.
+    """
+    h, w = image_shape
+    coordinates = [(int(x_val/100*w), int(y_val/100*h)-50) for x_val, y_val in points]
+    if not coordinates:
+        return None
+    coordinates.sort(key=lambda xy: xy[1])
     return coordinates
 
-def extrapolte_cords(cords, image_shape) -> MolmoResponse:
+def get_coords(output_string, image_shape):
+    """
+    Function to get x, y coordinates given Molmo model outputs.
+    Molmo points are percentages of the image size, so image_shape must be the
+    shape of the original page even if a downscaled copy was sent to the model.
+    :param output_string: Output from the Molmo model.
+    :param image_shape: (height, width) of the original page.
+    Returns:
+        coordinates: Coordinates in format of [(x, y), (x, y)]
+    """
+    return scale_points(parse_points(output_string), image_shape)
+
+def extrapolte_cords(cords, image_shape) -> List[BoundingBox]:
     if cords is None:
         return [] 
     height, width = image_shape
@@ -78,21 +116,24 @@ def extrapolte_cords(cords, image_shape) -> MolmoResponse:
 
 class MolmoAsyncClient():
     """Client for Molmo model via RunPod async API"""
-    def __init__(self, poll_interval: float = 5.0, endpoint_id:Optional[str] = None, api_key:Optional[str] = None):
+    def __init__(self, poll_interval: float = 5.0, endpoint_id:Optional[str] = None, api_key:Optional[str] = None, max_image_size: int = 1024, cassette: Optional[Cassette] = None):
         """ 
         Args:
         endpoint_id : Runpod endpoint_id
         api_key : Runpod API key 
         poll_interval: Seconds to wait between polling 
+        max_image_size: Longest side in pixels of images sent inline, Molmo resizes to its own crops anyway
+        cassette: Record/replay of responses, defaults to the LLM_CASSETTE_* env variables
         """
+        self.cassette = cassette or Cassette.from_env()
 
         endpoint_id = endpoint_id or os.environ.get("ENDPOINT_ID")
-        if not endpoint_id:
+        if not endpoint_id and not self.cassette.replaying:
             raise ValueError(
                 "The Endpoint ID must be provided either as an argument or via environment variable"
             )
         api_key = api_key or os.environ.get("RUNPOD_API_KEY")
-        if not api_key:
+        if not api_key and not self.cassette.replaying:
             raise ValueError(
                 "The RUNPOD_API_KEY must be provided either as an argument or via environment variable"
             )
@@ -101,6 +142,7 @@ class MolmoAsyncClient():
         self.endpoint_id = endpoint_id
         self.api_key = api_key
         self.poll_interval = poll_interval
+        self.max_image_size = max_image_size
         
     
     def _submit_job(self, input_data):
@@ -148,14 +190,50 @@ class MolmoAsyncClient():
             else:
                 await asyncio.sleep(self.poll_interval)  # Use async sleep
     
-    async def generate(self,prompt: str,image_url: str, image_shape: tuple)-> MolmoResponse:
-        input_data = {
-        "image": image_url,
-        "text": prompt}
-        job_id = self._submit_job(input_data=input_data)
-        response = await self._poll_job(job_id)
-        output = response['output']
-        bbox= extrapolte_cords(get_coords(output, image_shape), image_shape)
+    async def _run_job(self, build_input, request: dict) -> str:
+        """
+        Submit a job and return the raw model output, through the cassette if enabled.
+
+        Args:
+        build_input : Coroutine function returning the job input, only called when the job is sent
+        request : Cassette key of the job
+        """
+        async def call():
+            job_id = self._submit_job(input_data=await build_input())
+            response = await self._poll_job(job_id)
+            return response['output']
+
+        if not self.cassette.enabled:
+            return await call()
+        return await self.cassette.play("molmo", request, call)
+
+    async def generate(self,prompt: str,image_url: Optional[str] = None, image_shape: Optional[tuple] = None, image: Optional[Image.Image] = None)-> MolmoResponse:
+        """
+        Args:
+        prompt : Pointing prompt
+        image_url : Public url of the page, sent instead of the image when given
+        image_shape : (height, width) of the original page, required with image_url
+                      unless image is given, defaults to the size of image
+        image : Page in PIL format, sent inline (downscaled) when there is no image_url.
+                Recordings are keyed on its content either way, so they replay whichever
+                way the page was sent
+        """
+        if image is None and image_url is None:
+            raise ValueError("Either image or image_url must be provided")
+        if image is None and image_shape is None:
+            raise ValueError("image_shape must be provided with image_url")
+        image_shape = image_shape or (image.height, image.width)
+
+        async def build_input():
+            if image_url is not None:
+                return {"image": image_url, "text": prompt}
+            loop = asyncio.get_running_loop()
+            image_base64 = await loop.run_in_executor(None, encode_image, image, self.max_image_size)
+            return {"image_base64": image_base64, "text": prompt}
+
+        request = {"text": prompt, "image": digest_image(image) if image is not None else image_url}
+        output = await self._run_job(build_input, request)
         return MolmoResponse(
-            bbox=bbox
+            points=parse_points(output),
+            image_shape=image_shape
         )
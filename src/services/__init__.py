@@ -1,4 +1,6 @@
 from .answer_extraction import answer_extraction
 from .datamodels import SubmitQueryRequest
+from .work_queue import WorkQueue, SQLiteWorkQueue
+from .worker import answer_extraction_queued
 
-__all__ = ["answer_extraction", "SubmitQueryRequest"]
\ No newline at end of file
+__all__ = ["answer_extraction", "SubmitQueryRequest", "WorkQueue", "SQLiteWorkQueue", "answer_extraction_queued"]
\ No newline at end of file
@@ -5,10 +5,10 @@ from src.llm import GeminiAsyncClient, MolmoAsyncClient
 import asyncio
 import os
 from config import system_prompts,format_user_prompt
-import numpy as np
 from datetime import datetime
 import shutil
-from .utils import save_image_to_s3, combine_extraction_and_layout, pdf_to_images
+from .utils import save_image_to_s3, combine_extraction_and_layout
+from .page_store import PageStore
 from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
@@ -21,14 +21,49 @@ async def run_structured_inference(system_prompt, user_prompt, test_image, extra
         image=test_image,
         structure=extraction_structure
     )
+async def run_page_extraction(system_prompt, user_prompt, pages, index, page_slots):
+    # bound the number of spilled pages read back into memory at once,
+    # pages already in memory cost nothing extra and run freely
+    if not pages.is_spilled(index):
+        return await run_structured_inference(system_prompt, user_prompt, pages.get(index), extraction_structure)
+    async with page_slots:
+        return await run_structured_inference(system_prompt, user_prompt, pages.get(index), extraction_structure)
+def molmo_inline_images():
+    """Send pages to Molmo inline, needs a RunPod handler that reads "image_base64"."""
+    return os.environ.get("MOLMO_INLINE_IMAGES", "false").lower() == "true"
+
+def page_s3_key(extraction):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return f'{extraction["student_id"]}/{extraction["page_no"]}-{timestamp}.jpg'
+
 # code for inferenfce 
-async def run_layout_inference(prompt, image_url, image_shape):
+async def run_layout_inference(prompt, image, image_shape, s3_key):
     molmo_model = MolmoAsyncClient()
+    # replay serves recorded responses keyed on the page, nothing has to be uploaded
+    if molmo_inline_images() or molmo_model.cassette.replaying:
+        return  await molmo_model.generate(
+            prompt = prompt,
+            image= image,
+            image_shape= image_shape
+        )
+    # the handler downloads the page, upload it first
+    loop = asyncio.get_running_loop()
+    image_url = await loop.run_in_executor(None, save_image_to_s3, image, s3_key)
     return  await molmo_model.generate(
         prompt = prompt,
         image_url= image_url,
-        image_shape= image_shape
+        image_shape= image_shape,
+        image= image
     )
+async def run_page_layout(prompt, pages, index, page_slots, s3_key):
+    if not pages.is_spilled(index):
+        return await run_layout_inference(prompt, pages.get(index), pages.shape(index), s3_key)
+    async with page_slots:
+        return await run_layout_inference(prompt, pages.get(index), pages.shape(index), s3_key)
+
+def archive_page(pages, index, s3_key):
+    """Upload a full page to S3, only for archiving. Layout does not depend on it."""
+    return save_image_to_s3(snip = pages.get(index), s3_key= s3_key)
 
 async def answer_extraction(query:SubmitQueryRequest):
     ## convert the pdf url into images 
@@ -41,8 +76,8 @@ async def answer_extraction(query:SubmitQueryRequest):
     response = requests.get(query.pdf_url_path)
     with open(local_pdf_path, 'wb') as file:
         file.write(response.content)
-    # convert pdf to images
-    pdf_images = pdf_to_images(local_pdf_path)
+    # convert pdf to images, kept in a memory bounded page store
+    pages = PageStore.from_pdf(local_pdf_path)
 
     print("Downloaded and converted pdfs to images!!")
     # cleanup the entire folder
@@ -52,37 +87,43 @@ async def answer_extraction(query:SubmitQueryRequest):
     print("Temporary PDF directory cleaned up!")
     
     # #testing using local pdf     
-    # pdf_images = pdf_to_images("worksheet_test1.pdf")
+    # pages = PageStore.from_pdf("worksheet_test1.pdf")
     # print("loaded pdf from local!")
     
-    ## Aysnc Gemini Extraction calls 
-    #prepare promtps 
-    page_extract_system_prompt = system_prompts["page_extract_prompt"]
-    page_extract_user_prompt = format_user_prompt("page_extract_prompt")
-    prompts = [(page_extract_system_prompt, page_extract_user_prompt, image, extraction_structure) for image in pdf_images]
-    extraction_output = await asyncio.gather(*(run_structured_inference(*p) for p in prompts))
-    print("Extraction from gemini complete!!")
+    with pages:
+        ## Aysnc Gemini Extraction calls 
+        #prepare promtps 
+        page_extract_system_prompt = system_prompts["page_extract_prompt"]
+        page_extract_user_prompt = format_user_prompt("page_extract_prompt")
+        # only spilled pages take a slot, sized to the budget left over by the resident pages
+        page_slots = asyncio.Semaphore(pages.spill_slots())
+        extraction_output = await asyncio.gather(*(run_page_extraction(page_extract_system_prompt, page_extract_user_prompt, pages, index, page_slots) for index in range(len(pages))))
+        print("Extraction from gemini complete!!")
+
+        page_keys = [page_s3_key(out.structure) for out in extraction_output]
 
-    ## create alist of image urls and list of image shapes 
-    pdf_image_shapes = [np.array(image).shape[:2] for image in pdf_images]
-    pdf_image_paths = []
-    for out,page in zip(extraction_output, pdf_images):
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        s3_key = f'{out.structure["student_id"]}/{out.structure["page_no"]}-{timestamp}.jpg'
-        path = save_image_to_s3(snip = page, s3_key= s3_key)
-        pdf_image_paths.append(path)
-    print("Uploaded all images to S3")
+        ## Optionally archive the full pages to S3 in the background.
+        ## Without inline images every page is uploaded for Molmo anyway.
+        archive_tasks = []
+        if molmo_inline_images() and os.environ.get("ARCHIVE_PAGES", "false").lower() == "true":
+            loop = asyncio.get_running_loop()
+            for index, s3_key in enumerate(page_keys):
+                archive_tasks.append(loop.run_in_executor(None, archive_page, pages, index, s3_key))
 
-    ## Molmo bounding box detection 
-    prompt_list = [format_user_prompt("molmo_extraction_prompt", question_numbers =  out.structure["question_numbers"]) for out in extraction_output]
+        ## Molmo bounding box detection, pages are sent inline or as S3 urls
+        prompt_list = [format_user_prompt("molmo_extraction_prompt", question_numbers =  out.structure["question_numbers"]) for out in extraction_output]
+        bbox_outputs = await asyncio.gather(*(run_page_layout(prompt, pages, index, page_slots, s3_key) for index, (prompt, s3_key) in enumerate(zip(prompt_list, page_keys))))
+        print("Bounding box detection using molmo comlpted!")
 
-    prompts = [(prompt, image_url, image_shape) for prompt , image_url, image_shape in zip(prompt_list, pdf_image_paths, pdf_image_shapes)]
-    bbox_outputs = await asyncio.gather(*(run_layout_inference(*p) for p in prompts))
-    print("Bounding box detection using molmo comlpted!")
+        # pages are released while cropping, so the archive uploads must finish first
+        await asyncio.gather(*archive_tasks)
+        if archive_tasks:
+            print("Archived all pages to S3")
 
-    ##Define both outputs in usable form and combine
-    extraction_list =  [extraction.structure  for extraction in extraction_output]
-    bbox_list= [bbox.bbox for bbox in bbox_outputs] 
-    student_data = combine_extraction_and_layout(extraction_list, bbox_list, pdf_images, pdf_image_shapes)
+        ##Define both outputs in usable form and combine
+        extraction_list =  [extraction.structure  for extraction in extraction_output]
+        # cropping, encoding and uploading block, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        student_data = await loop.run_in_executor(None, combine_extraction_and_layout, extraction_list, bbox_outputs, pages)
     print("successfully combined student data!")
     return student_data
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""
+This module contains the array backed table of answer boxes for a document.
+Layout post-processing (scaling, extrapolation, continuation boxes, box count
+reconciliation and clamping) runs vectorised over every page at once, boxes are
+only converted to pydantic models where they leave the pipeline.
+"""
+from typing import List, Sequence
+import numpy as np
+from .datamodels import Point, BoundingBox
+
+# column layout of BoxTable.data
+PAGE, QUESTION, X0, Y0, X1, Y1 = range(6)
+# question index of a box holding the continuation of an answer from an earlier page
+CONTINUATION = -1
+# margins used for every answer box
+LEFT_MARGIN = 50
+RIGHT_MARGIN = 200
+TOP_MARGIN = 240
+BOTTOM_MARGIN = 50
+
+
+class BoxTable:
+    """Answer boxes of a document, one row per box.
+
+    Columns are page, question (index into the page's question numbers, or
+    CONTINUATION) and the x0/y0/x1/y1 corners. Corners are stored as built and
+    normalised by `clamp`.
+    """
+
+    def __init__(self, data: np.ndarray = None):
+        self.data = np.empty((0, 6), dtype=np.int64) if data is None else data
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def page(self) -> np.ndarray:
+        return self.data[:, PAGE]
+
+    @property
+    def question(self) -> np.ndarray:
+        return self.data[:, QUESTION]
+
+    @classmethod
+    def concat(cls, tables: Sequence["BoxTable"]) -> "BoxTable":
+        return cls(np.concatenate([table.data for table in tables]))
+
+    @classmethod
+    def from_points(cls, points_per_page: Sequence[Sequence[tuple]], shapes: np.ndarray) -> "BoxTable":
+        """
+        Build boxes from Molmo points, the vectorised form of get_coords and extrapolte_cords.
+
+        Args:
+            points_per_page: (x, y) percentage points for every page
+            shapes: (pages, 2) array of page (height, width)
+
+        Returns:
+            one box per point, running from the point down to the next point on the
+            page (or the bottom margin), numbered top to bottom
+        """
+        counts = np.array([len(points) for points in points_per_page], dtype=np.int64)
+        if counts.sum() == 0:
+            return cls()
+        page = np.repeat(np.arange(len(points_per_page)), counts)
+        points = np.array([point for points in points_per_page for point in points], dtype=np.float64)
+        height, width = shapes[page, 0], shapes[page, 1]
+
+        # scale percentages to pixels, the point sits 50px below the question number
+        x = np.trunc(points[:, 0] / 100 * width).astype(np.int64)
+        y = np.trunc(points[:, 1] / 100 * height).astype(np.int64) - 50
+
+        # sort top to bottom within each page
+        order = np.lexsort((y, page))
+        page, y, height, width = page[order], y[order], height[order], width[order]
+
+        # each box ends just above the next box on the same page
+        next_on_page = np.append(page[1:] == page[:-1], False)
+        y_end = np.where(next_on_page, np.append(y[1:], 0) - 10, height - BOTTOM_MARGIN)
+        question = np.arange(len(page)) - np.searchsorted(page, page, side="left")
+
+        return cls(np.column_stack([page, question, np.full_like(x, LEFT_MARGIN), y, width - RIGHT_MARGIN, y_end]))
+
+    @classmethod
+    def from_bounding_boxes(cls, page: int, bboxes: List[BoundingBox]) -> "BoxTable":
+        """Rows for the bounding boxes of a single page, numbered in list order."""
+        if not bboxes:
+            return cls()
+        rows = [
+            (page, question,
+             min(b.p1.x, b.p2.x, b.p3.x, b.p4.x), min(b.p1.y, b.p2.y, b.p3.y, b.p4.y),
+             max(b.p1.x, b.p2.x, b.p3.x, b.p4.x), max(b.p1.y, b.p2.y, b.p3.y, b.p4.y))
+            for question, b in enumerate(bboxes)
+        ]
+        return cls(np.array(rows, dtype=np.int64))
+
+    @classmethod
+    def full_page(cls, page: np.ndarray, question: np.ndarray, shapes: np.ndarray) -> "BoxTable":
+        """Default boxes covering the page between the margins."""
+        height, width = shapes[page, 0], shapes[page, 1]
+        return cls(np.column_stack([
+            page, question, np.full_like(page, LEFT_MARGIN), np.full_like(page, TOP_MARGIN),
+            width - RIGHT_MARGIN, height - BOTTOM_MARGIN,
+        ]).astype(np.int64))
+
+    def counts(self, pages: int) -> np.ndarray:
+        """Number of boxes on every page."""
+        return np.bincount(self.page, minlength=pages)
+
+    def select(self, mask: np.ndarray) -> "BoxTable":
+        return BoxTable(self.data[mask])
+
+    def for_page(self, page: int) -> "BoxTable":
+        return self.select(self.page == page)
+
+    def drop_pages(self, page_mask: np.ndarray) -> "BoxTable":
+        """Drop every box of the pages set in page_mask."""
+        return self.select(~page_mask[self.page])
+
+    def replace_page(self, page: int, boxes: "BoxTable") -> "BoxTable":
+        return BoxTable.concat([self.select(self.page != page), boxes])
+
+    def continuation_boxes(self, continuation_mask: np.ndarray, shapes: np.ndarray) -> "BoxTable":
+        """
+        Boxes for pages that start with the continuation of an earlier answer.
+        They run from the top margin down to just above the first box on the page,
+        or to the bottom margin if the page has no boxes.
+        """
+        pages = np.flatnonzero(continuation_mask)
+        boxes = BoxTable.full_page(pages, np.full_like(pages, CONTINUATION), shapes)
+        first = self.select(self.question == 0)
+        has_first = np.zeros(len(shapes), dtype=bool)
+        first_y = np.zeros(len(shapes), dtype=np.int64)
+        has_first[first.page] = True
+        first_y[first.page] = first.data[:, Y0]
+        boxes.data[:, Y1] = np.where(has_first[pages], first_y[pages] - 10, boxes.data[:, Y1])
+        return boxes
+
+    def reconcile(self, question_counts: np.ndarray, shapes: np.ndarray) -> "BoxTable":
+        """
+        Match the number of boxes to the number of questions on every page.
+        Boxes beyond the question count are dropped, pages with fewer boxes than
+        questions get a full page box for every question.
+        """
+        boxes = self.select(self.question < question_counts[self.page])
+        short = boxes.counts(len(shapes)) < question_counts
+        page = np.repeat(np.flatnonzero(short), question_counts[short])
+        question = np.arange(len(page)) - np.searchsorted(page, page, side="left")
+        return BoxTable.concat([boxes.drop_pages(short), BoxTable.full_page(page, question, shapes)])
+
+    def sort(self) -> "BoxTable":
+        """Order by page, continuation box first, then by question."""
+        return BoxTable(self.data[np.lexsort((self.question, self.page))])
+
+    def clamp(self, shapes: np.ndarray) -> "BoxTable":
+        """Normalise corners so x0 <= x1 and y0 <= y1 and clip every box to its page, at least 1px in size."""
+        data = self.data.copy()
+        height, width = shapes[data[:, PAGE], 0], shapes[data[:, PAGE], 1]
+        for low, high, limit in ((X0, X1, width), (Y0, Y1, height)):
+            start = np.clip(np.minimum(data[:, low], data[:, high]), 0, limit - 1)
+            end = np.clip(np.maximum(data[:, low], data[:, high]), 0, limit)
+            data[:, low], data[:, high] = start, np.maximum(end, start + 1)
+        return BoxTable(data)
+
+    def extents(self) -> List[tuple]:
+        """(left, top, right, bottom) of every box, for cropping."""
+        return [tuple(row) for row in self.data[:, X0:].tolist()]
+
+    def to_bounding_boxes(self) -> List[BoundingBox]:
+        """Convert to pydantic models, corners laid out as extrapolte_cords builds them."""
+        return [
+            BoundingBox(p1=Point(x=x0, y=y0), p2=Point(x=x1, y=y0), p3=Point(x=x0, y=y1), p4=Point(x=x1, y=y1))
+            for x0, y0, x1, y1 in self.data[:, X0:].tolist()
+        ]
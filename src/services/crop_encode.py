@@ -0,0 +1,188 @@
+"""
+This module contains the crop and encode stage for answer snips.
+Cropping and JPEG/WebP encoding are CPU bound, so the regions of a document
+are fanned out to a process pool. Page pixels are passed to the workers
+through shared memory instead of pickling whole images.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context, shared_memory
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+
+def encode_snip(image: Image.Image, box: Tuple[int, int, int, int], format: str, quality: int) -> bytes:
+    """Crop a (left, top, right, bottom) box from a PIL image and encode it."""
+    snip_io = BytesIO()
+    image.crop(box).save(snip_io, format=format, quality=quality)
+    return snip_io.getvalue()
+
+
+def _encode_shared_snip(shm_name: str, shape: tuple, box: Tuple[int, int, int, int], format: str, quality: int) -> bytes:
+    """Process pool task, crops a box from a page held in shared memory and encodes it."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        page = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        height, width = shape[:2]
+        left, top, right, bottom = box
+        # same as PIL crop, area outside the page is black
+        snip = np.zeros((bottom - top, right - left, 3), dtype=np.uint8)
+        x0, y0, x1, y1 = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+        if x1 > x0 and y1 > y0:
+            snip[y0 - top:y1 - top, x0 - left:x1 - left] = page[y0:y1, x0:x1]
+        del page
+    finally:
+        shm.close()
+    snip_io = BytesIO()
+    Image.fromarray(snip).save(snip_io, format=format, quality=quality)
+    return snip_io.getvalue()
+
+
+class CropEncoder:
+    """Crops and encodes answer snips, in a process pool when available."""
+
+    def __init__(self, processes: Optional[int] = None, format: Optional[str] = None, quality: Optional[int] = None, max_pages_in_flight: Optional[int] = None):
+        """
+        Args:
+        processes : Pool size, defaults to SNIP_ENCODE_PROCESSES env variable or the cpu count.
+                    0 encodes in the calling process (used on Lambda, which has no /dev/shm)
+        format : JPEG or WEBP, defaults to SNIP_FORMAT env variable or JPEG
+        quality : Encode quality, defaults to SNIP_QUALITY env variable or 75
+        max_pages_in_flight : Pages held in shared memory at once, defaults to 2 x processes
+        """
+        if processes is None:
+            on_lambda = "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+            processes = int(os.environ.get("SNIP_ENCODE_PROCESSES", 0 if on_lambda else os.cpu_count()))
+        format = (format or os.environ.get("SNIP_FORMAT", "JPEG")).upper()
+        if format not in FORMATS:
+            raise ValueError(f"Snip format must be one of {list(FORMATS)}, got '{format}'")
+        self.processes = processes
+        self.format = format
+        self.quality = quality or int(os.environ.get("SNIP_QUALITY", 75))
+        self.extension, self.content_type = FORMATS[format]
+        self.max_pages_in_flight = max_pages_in_flight or max(1, 2 * processes)
+        self.pool = None
+        self.stats = {"snips": 0, "bytes": 0, "seconds": 0.0}
+        # the process wide encoder is shared by requests running in executor threads
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """Return the pool, starting it and waiting for every worker on first use,
+        so start-up is not counted as encode time."""
+        with self._lock:
+            if self.pool is None:
+                start = time.perf_counter()
+                pool = ProcessPoolExecutor(self.processes, mp_context=get_context("spawn"))
+                for future in [pool.submit(os.getpid) for _ in range(self.processes)]:
+                    future.result()
+                self.pool = pool
+                print(f"Started snip encode pool of {self.processes} processes in {time.perf_counter() - start:.2f}s")
+            return self.pool
+
+    def _drop_pool(self, pool: ProcessPoolExecutor):
+        """Shut down a broken pool, unless another thread has already replaced it."""
+        with self._lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def encode(self, page_crops: Iterable[Tuple[Image.Image, List[Tuple[int, int, int, int]]]]) -> List[List[bytes]]:
+        """
+        Crop and encode the boxes of every page.
+
+        Args:
+            page_crops: iterable of (page image, list of (left, top, right, bottom) boxes).
+                        The iterable is consumed lazily, each image is only needed until
+                        the next page is requested.
+
+        Returns:
+            list of encoded snips per page, in the order of the boxes
+        """
+        pool = self._get_pool() if self.processes > 0 else None
+        start = time.perf_counter()
+        if pool is None:
+            results = [[encode_snip(image, box, self.format, self.quality) for box in boxes] for image, boxes in page_crops]
+        else:
+            try:
+                results = self._encode_in_pool(pool, page_crops)
+            except BrokenProcessPool:
+                # a worker died, start a fresh pool for the next call
+                self._drop_pool(pool)
+                raise
+        self._report(results, time.perf_counter() - start)
+        return results
+
+    def _encode_in_pool(self, pool, page_crops):
+        futures_per_page = []
+        in_flight = deque()
+        try:
+            for image, boxes in page_crops:
+                if not boxes:
+                    futures_per_page.append([])
+                    continue
+                pixels = np.asarray(image)
+                shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+                np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[:] = pixels
+                del pixels
+                futures = [
+                    pool.submit(_encode_shared_snip, shm.name, (image.height, image.width, 3), tuple(box), self.format, self.quality)
+                    for box in boxes
+                ]
+                futures_per_page.append(futures)
+                in_flight.append((shm, futures))
+                # bound the shared memory held at once
+                while len(in_flight) > self.max_pages_in_flight:
+                    self._finish_page(*in_flight.popleft())
+            while in_flight:
+                self._finish_page(*in_flight.popleft())
+        finally:
+            for shm, _ in in_flight:
+                shm.close()
+                shm.unlink()
+        return [[future.result() for future in futures] for futures in futures_per_page]
+
+    @staticmethod
+    def _finish_page(shm, futures):
+        try:
+            for future in futures:
+                future.exception()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _report(self, results, seconds):
+        snips = sum(len(page) for page in results)
+        encoded_bytes = sum(len(snip) for page in results for snip in page)
+        with self._lock:
+            self.stats["snips"] += snips
+            self.stats["bytes"] += encoded_bytes
+            self.stats["seconds"] += seconds
+        if snips:
+            print(f"Encoded {snips} snips ({encoded_bytes / 1e6:.1f} MB {self.format}) in {seconds:.2f}s, {snips / seconds:.1f} snips/s")
+
+    def shutdown(self):
+        with self._lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+_encoder = None
+
+def get_crop_encoder() -> CropEncoder:
+    """Process wide encoder, so the pool is started once and reused across requests."""
+    global _encoder
+    if _encoder is None:
+        _encoder = CropEncoder()
+    return _encoder
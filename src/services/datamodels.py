@@ -3,20 +3,8 @@ This module contains all data models
 """
 from pydantic import BaseModel
 from typing import List 
-
-
-class Point(BaseModel):
-    x: int
-    y: int
-
-class BoundingBox(BaseModel):
-    p1: Point
-    p2: Point
-    p3: Point
-    p4: Point
-
-class MolmoResponse(BaseModel):
-    bbox: List[BoundingBox]
+# layout models are defined once, next to the Molmo client
+from src.llm.molmo_client import Point, BoundingBox, MolmoResponse
 
 
 # class to submit the input 
@@ -0,0 +1,128 @@
+"""
+This module contains the page store used to hold rendered pdf pages.
+Page geometry is kept separately from the pixels, pages beyond the memory
+budget are spilled to memory-mapped files and each page can be released
+once its crops are done.
+"""
+import os
+import shutil
+import tempfile
+from typing import Optional
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+
+class PageStore:
+    """Memory bounded store of rendered pdf pages."""
+
+    def __init__(self, memory_budget_mb: Optional[float] = None, spill_dir: Optional[str] = None):
+        """
+        Args:
+        memory_budget_mb : Pixels kept in memory before pages are spilled to disk,
+                           defaults to PAGE_STORE_MEMORY_MB env variable or 512
+        spill_dir : Directory for the memory-mapped page files, defaults to PAGE_STORE_DIR
+                    env variable or the system temp directory
+        """
+        memory_budget_mb = memory_budget_mb or float(os.environ.get("PAGE_STORE_MEMORY_MB", 512))
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.spill_dir = tempfile.mkdtemp(prefix="pages-", dir=spill_dir or os.environ.get("PAGE_STORE_DIR"))
+        self.shapes = []
+        self._pages = []
+        self._resident_bytes = 0
+
+    @classmethod
+    def from_pdf(cls, pdf_path: str, dpi: int = 200, **kwargs) -> "PageStore":
+        """Render every page of a pdf into a new store."""
+        store = cls(**kwargs)
+        mat = fitz.Matrix(dpi/72, dpi/72)  # scale for DPI
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                pix = page.get_pixmap(matrix=mat)
+                store.add_pixels(np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n))
+                del pix
+        return store
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, image: Image.Image) -> int:
+        """Add a PIL image to the store and return its page index."""
+        image = image.convert("RGB")
+        width, height = image.size
+        if self._resident_bytes + height * width * 3 <= self.memory_budget:
+            return self._keep(image)
+        return self._spill(np.asarray(image))
+
+    def add_pixels(self, pixels: np.ndarray) -> int:
+        """Add an (height, width, 3) uint8 array to the store and return its page index."""
+        if self._resident_bytes + pixels.nbytes <= self.memory_budget:
+            return self._keep(Image.fromarray(pixels))
+        return self._spill(pixels)
+
+    def _keep(self, image: Image.Image) -> int:
+        width, height = image.size
+        self.shapes.append((height, width))
+        self._pages.append(image)
+        self._resident_bytes += height * width * 3
+        return len(self.shapes) - 1
+
+    def _spill(self, pixels: np.ndarray) -> int:
+        index = len(self.shapes)
+        path = os.path.join(self.spill_dir, f"{index}.raw")
+        spilled = np.memmap(path, dtype=np.uint8, mode="w+", shape=pixels.shape)
+        spilled[:] = pixels
+        spilled.flush()
+        del spilled
+        self.shapes.append(pixels.shape[:2])
+        self._pages.append(path)
+        return index
+
+    def shape(self, index: int) -> tuple:
+        """(height, width) of a page, without touching the pixels."""
+        return self.shapes[index]
+
+    def get(self, index: int) -> Image.Image:
+        """Return a page as a PIL image. Spilled pages are read back from disk."""
+        page = self._pages[index]
+        if page is None:
+            raise KeyError(f"Page {index} has already been released")
+        if isinstance(page, Image.Image):
+            return page
+        height, width = self.shapes[index]
+        pixels = np.memmap(page, dtype=np.uint8, mode="r", shape=(height, width, 3))
+        return Image.fromarray(pixels)
+
+    def is_spilled(self, index: int) -> bool:
+        """Whether a page lives on disk, so get() reads a fresh copy into memory."""
+        return isinstance(self._pages[index], str)
+
+    def release(self, index: int):
+        """Drop the pixels of a page. Its geometry is kept."""
+        page = self._pages[index]
+        if isinstance(page, Image.Image):
+            height, width = self.shapes[index]
+            self._resident_bytes -= height * width * 3
+        elif page is not None:
+            os.remove(page)
+        self._pages[index] = None
+
+    def spill_slots(self) -> int:
+        """Number of spilled pages that can be read back at once without going over the
+        memory budget, on top of the pages already held in memory. At least 1."""
+        if not self.shapes:
+            return 1
+        largest = max(height * width * 3 for height, width in self.shapes)
+        return max(1, (self.memory_budget - self._resident_bytes) // largest)
+
+    def close(self):
+        """Release every page and remove the spill directory."""
+        self._pages = [None] * len(self.shapes)
+        self._resident_bytes = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
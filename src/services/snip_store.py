@@ -0,0 +1,182 @@
+"""
+This module contains the storage for answer snips.
+Snips are stored under a key derived from a hash of their encoded bytes, so
+identical crops (repeated fallback boxes, resubmitted booklets, retries) map
+to the same object and are only uploaded once.
+"""
+import hashlib
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Sequence
+import boto3
+from botocore.exceptions import ClientError
+
+
+def content_key(data: bytes, extension: str, prefix: str = "snips") -> str:
+    """Storage key for encoded snip bytes."""
+    return f"{prefix}/{hashlib.sha256(data).hexdigest()}.{extension}"
+
+
+class SnipStore(ABC):
+    """Abstract base class for snip storage backends."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        """Whether an object is already stored under key."""
+        pass
+
+    @abstractmethod
+    def put(self, key: str, data: bytes, content_type: str):
+        """Store data under key."""
+        pass
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        """Url of the object stored under key."""
+        pass
+
+
+class S3SnipStore(SnipStore):
+    """Snips stored in the S3 bucket, existence checked with HEAD requests."""
+
+    def __init__(self, bucket_name: Optional[str] = None, region: Optional[str] = None, client=None):
+        self.bucket_name = bucket_name or os.environ.get("S3_BUCKET_NAME")
+        self.region = region or os.environ.get("S3_REGION")
+        self.client = client or boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get("S3_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.environ.get("S3_SECRET_ACCESS_KEY"),
+            region_name=self.region
+        )
+        self._warned_forbidden = False
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in {"404", "NoSuchKey", "NotFound"}:
+                return False
+            # without s3:ListBucket a missing key answers 403, treat it as unknown and upload
+            if code in {"403", "Forbidden", "AccessDenied"}:
+                if not self._warned_forbidden:
+                    print("HEAD on snips is forbidden, uploading every snip. Grant s3:GetObject and s3:ListBucket to skip stored snips")
+                    self._warned_forbidden = True
+                return False
+            raise
+        return True
+
+    def put(self, key: str, data: bytes, content_type: str):
+        self.client.upload_fileobj(BytesIO(data), self.bucket_name, key, ExtraArgs={'ContentType': content_type})
+
+    def url(self, key: str) -> str:
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+
+
+class LocalSnipStore(SnipStore):
+    """Snips stored in a local directory, a stand-in for S3 when working offline."""
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = os.path.abspath(directory or os.environ.get("SNIP_STORE_DIR", "snip_store"))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def put(self, key: str, data: bytes, content_type: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so a reader never sees a partial snip
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+
+    def url(self, key: str) -> str:
+        return f"file://{self._path(key)}"
+
+
+class SnipUploader:
+    """Uploads snips under content addressed keys, skipping keys that are already stored.
+
+    Keys seen by this process are remembered for known_key_ttl seconds, so repeated
+    snips cost neither a HEAD nor a PUT. Other keys are checked with the store before
+    uploading. The TTL bounds how long a snip deleted from the store (e.g. by a bucket
+    lifecycle rule) can still be handed out without being uploaded again, keep it
+    well below any expiry configured on the bucket.
+    """
+
+    def __init__(self, store: SnipStore, prefix: Optional[str] = None, max_known_keys: int = 100000,
+                 known_key_ttl: Optional[float] = None, threads: Optional[int] = None):
+        """
+        Args:
+        store : SnipStore the snips are saved to
+        prefix : Key prefix, defaults to SNIP_KEY_PREFIX env variable or snips
+        max_known_keys : Number of remembered keys
+        known_key_ttl : Seconds a key is remembered, defaults to SNIP_KNOWN_KEY_TTL env variable or 3600.
+                        0 checks the store for every snip
+        threads : Concurrent uploads in save_many, defaults to SNIP_UPLOAD_THREADS env variable or 10
+                  (the size of the boto3 connection pool)
+        """
+        self.store = store
+        self.prefix = prefix or os.environ.get("SNIP_KEY_PREFIX", "snips")
+        self.max_known_keys = max_known_keys
+        self.known_key_ttl = float(os.environ.get("SNIP_KNOWN_KEY_TTL", 3600)) if known_key_ttl is None else known_key_ttl
+        self.threads = threads or int(os.environ.get("SNIP_UPLOAD_THREADS", 10))
+        self.known_keys = {}  # key -> time it was last seen stored
+        self.stats = {"uploaded": 0, "skipped": 0}
+        self._lock = threading.Lock()
+
+    def _is_known(self, key: str) -> bool:
+        seen = self.known_keys.get(key)
+        return seen is not None and time.monotonic() - seen < self.known_key_ttl
+
+    def _remember(self, key: str):
+        now = time.monotonic()
+        if len(self.known_keys) >= self.max_known_keys:
+            self.known_keys = {k: seen for k, seen in self.known_keys.items() if now - seen < self.known_key_ttl}
+            if len(self.known_keys) >= self.max_known_keys:
+                self.known_keys.clear()
+        self.known_keys[key] = now
+
+    def save(self, data: bytes, extension: str, content_type: str) -> str:
+        """Store an encoded snip if it is not stored yet and return its url."""
+        key = content_key(data, extension, self.prefix)
+        with self._lock:
+            known = self._is_known(key)
+        if known or self.store.exists(key):
+            stat = "skipped"
+        else:
+            self.store.put(key, data, content_type)
+            stat = "uploaded"
+        with self._lock:
+            self.stats[stat] += 1
+            self._remember(key)
+        return self.store.url(key)
+
+    def save_many(self, snips: Sequence[bytes], extension: str, content_type: str) -> List[str]:
+        """Store several encoded snips concurrently, returns their urls in order."""
+        if len(snips) <= 1:
+            return [self.save(data, extension, content_type) for data in snips]
+        with ThreadPoolExecutor(min(self.threads, len(snips))) as pool:
+            return list(pool.map(lambda data: self.save(data, extension, content_type), snips))
+
+
+_uploader = None
+
+def get_snip_uploader() -> SnipUploader:
+    """Process wide uploader, the known-key index is kept across requests.
+    Uses the local store when SNIP_STORE=local, S3 otherwise."""
+    global _uploader
+    if _uploader is None:
+        if os.environ.get("SNIP_STORE", "s3").lower() == "local":
+            store = LocalSnipStore()
+        else:
+            store = S3SnipStore()
+        _uploader = SnipUploader(store)
+    return _uploader
@@ -5,12 +5,15 @@ import os
 import boto3
 from io import BytesIO
 from PIL import Image
-from .datamodels import Point, BoundingBox
-from datetime import datetime
+from .datamodels import BoundingBox
 from collections import defaultdict
 from config import system_prompts, format_user_prompt
 from google import genai
-import uuid
+from src.llm.cassette import Cassette, digest_image
+from .crop_encode import get_crop_encoder
+from .box_table import BoxTable, CONTINUATION
+from .snip_store import get_snip_uploader
+import numpy as np
 from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
@@ -27,19 +30,23 @@ def save_image_to_s3(snip: Image.Image, s3_key: str) -> str:
     """
     Save a PIL image to S3 and return its public URL.
     """
-    bucket_name = os.environ.get("S3_BUCKET_NAME")
-    
     # Create an in-memory file-like object to hold the image
     image_io = BytesIO()
     snip.save(image_io, format='JPEG')  # Save PIL image directly
-    image_io.seek(0)  # Reset file pointer
+    return save_bytes_to_s3(image_io.getvalue(), s3_key, 'image/jpeg')
+
+def save_bytes_to_s3(data: bytes, s3_key: str, content_type: str) -> str:
+    """
+    Save an already encoded image to S3 and return its public URL.
+    """
+    bucket_name = os.environ.get("S3_BUCKET_NAME")
 
     # Upload the image to S3
     s3_client.upload_fileobj(
-        image_io,
+        BytesIO(data),
         bucket_name,
         s3_key,
-        ExtraArgs={'ContentType': 'image/jpeg'}
+        ExtraArgs={'ContentType': content_type}
     )
 
     # Generate the S3 URL for the uploaded image
@@ -49,39 +56,157 @@ def save_image_to_s3(snip: Image.Image, s3_key: str) -> str:
     return image_url
 
 # utils for crop from bouding box 
-def crop_bounding_box(img: Image.Image, bbox: BoundingBox) -> Image.Image:
+def bounding_box_extent(bbox: BoundingBox) -> tuple:
     """
-    Crop an axis-aligned bounding box from a PIL image.
+    (left, top, right, bottom) of an axis-aligned bounding box.
     """
     # get min/max coordinates
     left = min(bbox.p1.x, bbox.p2.x, bbox.p3.x, bbox.p4.x)
     right = max(bbox.p1.x, bbox.p2.x, bbox.p3.x, bbox.p4.x)
     top = min(bbox.p1.y, bbox.p2.y, bbox.p3.y, bbox.p4.y)
     bottom = max(bbox.p1.y, bbox.p2.y, bbox.p3.y, bbox.p4.y)
-    
-    # crop image
-    return img.crop((left, top, right, bottom))
+    return (left, top, right, bottom)
+
+def crop_bounding_box(img: Image.Image, bbox: BoundingBox) -> Image.Image:
+    """
+    Crop an axis-aligned bounding box from a PIL image.
+    """
+    return img.crop(bounding_box_extent(bbox))
+
+# utils for merging molmo bounding boxes with gemini
+def verify_bboxes(image: Image.Image, bboxes, question_numbers):
+    """
+    Ask Gemini to merge the detected bounding boxes into one box per question.
+    Goes through the LLM_CASSETTE_* record/replay settings like the model clients.
+    """
+    verification_prompt = format_user_prompt("verification_prompt", bboxes = bboxes, question_numbers = question_numbers)
+
+    def call():
+        client = genai.Client(api_key = os.environ.get("GEMINI_API_KEY"))
+        response = client.models.generate_content(
+        model="gemini-2.5-flash",
+        contents= [image, verification_prompt],
+        config={
+            "response_mime_type": "application/json",
+            "response_schema": list[BoundingBox],
+        },)
+        return [bbox.model_dump() for bbox in response.parsed]
+
+    cassette = Cassette.from_env()
+    if cassette.enabled:
+        request = {"model": "gemini-2.5-flash", "prompt": verification_prompt, "image": digest_image(image)}
+        response = cassette.play_sync("verification", request, call)
+    else:
+        response = call()
+    return [BoundingBox(**bbox) for bbox in response]
 
 # utils for combining extraction and layout data 
-def combine_extraction_and_layout(extraction_list, bbox_list, image_list, image_shapes):
+def plan_document_crops(extraction_list, layout_outputs, image_shapes, load_image):
     """
-    Combine extraction data and layout data into student-based structure.
-    
+    Fix up the layout of every page of a document and decide which regions to crop.
+
     Args:
         extraction_list: list of dicts, each representing extraction for a page
-        bbox_list: list of lists, each containing TextBlock objects for a page
-    
+        layout_outputs: list of MolmoResponse, one per page
+        image_shapes: list of (height, width) of every page
+        load_image: callable taking a page index and returning the page image,
+                    only used when Gemini has to merge boxes
+
+    Returns:
+        BoxTable sorted by page, with the continuation box (question CONTINUATION)
+        first and then one box per question number
+    """
+    shapes = np.asarray(image_shapes, dtype=np.int64).reshape(-1, 2)
+    question_counts = np.array([len(extraction.get("question_numbers")) for extraction in extraction_list], dtype=np.int64)
+    continuation = np.array([extraction.get("starts_with_continuation") == "true" for extraction in extraction_list], dtype=bool)
+    boxes = BoxTable.from_points([layout.points for layout in layout_outputs], shapes)
+
+    # Fixing Molmo Reponses 
+    #1. if expected question numbers are empty discard any detected bouding boxes!
+    boxes = boxes.drop_pages(question_counts == 0)
+
+    #2. check if the len(question_numbers) < len(bboxes). Molmo identified more bboxes
+    # update bboxes with the merged fucntion
+    for page in np.flatnonzero(question_counts < boxes.counts(len(shapes))):
+        print("Molmo Failed! Merging with Gemini flash!")
+        bboxes = verify_bboxes(load_image(page), boxes.for_page(page).to_bounding_boxes(), extraction_list[page].get("question_numbers"))
+        boxes = boxes.replace_page(page, BoxTable.from_bounding_boxes(page, bboxes))
+
+    # check if the extraction contains "continuation"
+    continuations = boxes.continuation_boxes(continuation, shapes)
+
+    # Prevent bboxes out of index issue. 
+    # A failing case handle where detected boudning boxes are less than numebr of questions expected, fill full page bouding boxes for all question answers
+    boxes = boxes.reconcile(question_counts, shapes)
+
+    return BoxTable.concat([continuations, boxes]).sort().clamp(shapes)
+
+def page_snip_paths(extraction, page_boxes, paths):
+    """
+    Attach the stored snip paths of a page to its question numbers.
+
+    Returns:
+        dict with the continuation snip path (or None) and a list of
+        [question_number, path] pairs in the order they appear on the page
+    """
+    question_numbers = extraction.get("question_numbers")
+    page_result = {"continuation": None, "answers": []}
+    for question, path in zip(page_boxes.question.tolist(), paths):
+        if question == CONTINUATION:
+            page_result["continuation"] = path
+        else:
+            page_result["answers"].append([question_numbers[question], path])
+    return page_result
+
+def upload_page_snips(extraction, page_boxes, snips, encoder, uploader=None):
+    """
+    Upload the encoded snips of a page under content addressed keys.
+
+    Returns:
+        dict as returned by page_snip_paths
+    """
+    uploader = uploader or get_snip_uploader()
+    paths = uploader.save_many(snips, encoder.extension, encoder.content_type)
+    return page_snip_paths(extraction, page_boxes, paths)
+
+def crop_page_answers(extraction, layout, image, image_shape, encoder=None):
+    """
+    Fix up the layout of a single page, crop, encode and upload the answer snips.
+
+    Args:
+        extraction: dict, extraction for the page
+        layout: MolmoResponse for the page
+        image: page image in PIL format
+        image_shape: (height, width) of the page
+        encoder: CropEncoder, defaults to the process wide encoder
+
+    Returns:
+        dict with the continuation snip path (or None) and a list of
+        [question_number, path] pairs in the order they appear on the page
+    """
+    encoder = encoder or get_crop_encoder()
+    boxes = plan_document_crops([extraction], [layout], [image_shape], lambda page: image)
+    snips = encoder.encode([(image, boxes.extents())])[0]
+    return upload_page_snips(extraction, boxes, snips, encoder)
+
+def group_student_pages(extraction_list, page_results):
+    """
+    Group per-page results into student-based structure.
+
+    Pages must be given in document order, a continuation snip is attached
+    to the last question answered by the same student on an earlier page.
+
+    Args:
+        extraction_list: list of dicts, each representing extraction for a page
+        page_results: list of dicts, as returned by crop_page_answers
+
     Returns:
         List of dicts, each representing a student and their combined page data
     """
     # Group by student_id and record details 
-    # 
     students = {} 
-    page = 1
-    for extraction, bboxes, image, image_shape in zip(extraction_list, bbox_list, image_list, image_shapes):
+    for extraction, page_result in zip(extraction_list, page_results):
         student_id = extraction.get("student_id")
-        print(f"Running extraction of page{page}")
-        page += 1
         if student_id not in students:
             students[student_id] = {
                 "student_id": student_id,
@@ -90,65 +215,19 @@ def combine_extraction_and_layout(extraction_list, bbox_list, image_list, image_
                 "question_answered": [],
                 "answers": defaultdict(list)
             }
-        question_numbers = extraction.get("question_numbers")
-        
-        # Fixing Molmo Reponses 
-        #1. if expected question numbers are empty discard any detected bouding boxes!
-        if question_numbers == []:
-            bboxes = []
-        
-        #2. check if the len(question_numbers) < len(bboxes). Molmo identified more bboxes
-        # update bboxes with the merged fucntion
-        if len(question_numbers) < len(bboxes):
-            print("Molmo Failed! Merging with Gemini flash!")
-            verification_prompt = format_user_prompt("verification_prompt", bboxes = bboxes, question_numbers = question_numbers)
-            client = genai.Client(api_key = os.environ.get("GEMINI_API_KEY"))
-            response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents= [image, verification_prompt],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": list[BoundingBox],
-            },)
-            bboxes = response.parsed
-
-        # check if the extraction contains "continuation"
-        if extraction.get("starts_with_continuation") == "true":
-            height, width = image_shape
-            if bboxes != []:
-                # create a defualt bounding box
-                bbox = BoundingBox(p1=Point(x=50, y= 240), p2 = Point(x=width-200, y = 240), p3 = Point(x= 50, y= bboxes[0].p1.y- 10), p4 = Point(x= width-200, y= bboxes[0].p1.y- 10 ))
-            else:
-                bbox = BoundingBox(p1=Point(x=50, y = 240), p2 = Point(x= width-200, y = 240), p3 = Point(x = 50, y= height - 50), p4 = Point(x = width-200, y = height-50))
-            
-            snip = crop_bounding_box(image, bbox)
-            if students[student_id]["question_answered"]:
-                question_number = students[student_id]["question_answered"][-1] # last answered question
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                s3_key = f'{student_id}/{question_number}-cont-{timestamp}-{uuid.uuid4().hex}.jpg'
-                path = save_image_to_s3(snip, s3_key)
-                # add the image url to question path
-                students[student_id]["answers"][question_number].append(path)
+
+        # continuation of the last answered question
+        if page_result["continuation"] and students[student_id]["question_answered"]:
+            question_number = students[student_id]["question_answered"][-1] # last answered question
+            students[student_id]["answers"][question_number].append(page_result["continuation"])
         
         # add page numbers 
         students[student_id]["page_numbers"].append(extraction.get("page_no"))
 
         # add question ids
-        students[student_id]["question_answered"].extend(question_numbers)
-        
-        # Prevent bboxes out of index issue. 
-        # A failing case handle where detected boudning boxes are less than numebr of questions expected, fill full page bouding boxes for all question answers
-        if len(question_numbers) > len(bboxes):
-            bboxes = [BoundingBox(p1=Point(x=50, y = 240), p2 = Point(x= width-200, y = 240), p3 = Point(x = 50, y= height - 50), p4 = Point(x = width-200, y = height-50)) for _ in question_numbers]
-        
-        # iterate through question numbers 
-        for i, question_number in enumerate(question_numbers):
-            bbox = bboxes[i]
-            snip = crop_bounding_box(image, bbox)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            s3_key = f'{student_id}/{question_number}-{timestamp}-{uuid.uuid4().hex}.jpg' 
-            path = save_image_to_s3(snip,s3_key)
-            # add the question id 
+        students[student_id]["question_answered"].extend(extraction.get("question_numbers"))
+
+        for question_number, path in page_result["answers"]:
             students[student_id]["answers"][question_number].append(path)
     
     #transform the answers section 
@@ -163,22 +242,83 @@ def combine_extraction_and_layout(extraction_list, bbox_list, image_list, image_
     
     return list(students.values())
 
+def continuations_used(extraction_list):
+    """
+    Pages whose continuation snip will be attached to an answer, i.e. the same
+    student answered a question on an earlier page.
+    """
+    answered = set()
+    used = np.zeros(len(extraction_list), dtype=bool)
+    for index, extraction in enumerate(extraction_list):
+        student_id = extraction.get("student_id")
+        used[index] = student_id in answered
+        if extraction.get("question_numbers"):
+            answered.add(student_id)
+    return used
+
+def combine_extraction_and_layout(extraction_list, layout_outputs, pages, encoder=None):
+    """
+    Combine extraction data and layout data into student-based structure.
+    The snips of the whole document are cropped and encoded in one pass of the
+    crop encoder, each page is released from the page store once it has been handed over.
+    
+    Args:
+        extraction_list: list of dicts, each representing extraction for a page
+        layout_outputs: list of MolmoResponse, one per page
+        pages: PageStore holding the page images
+        encoder: CropEncoder, defaults to the process wide encoder
+    
+    Returns:
+        List of dicts, each representing a student and their combined page data
+    """
+    encoder = encoder or get_crop_encoder()
+    boxes = plan_document_crops(extraction_list, layout_outputs, pages.shapes, pages.get)
+    # skip continuation snips group_student_pages would throw away
+    used = continuations_used(extraction_list)
+    boxes = boxes.select((boxes.question != CONTINUATION) | used[boxes.page])
+    page_boxes = [boxes.for_page(index) for index in range(len(extraction_list))]
+
+    def pages_to_encode():
+        for index, boxes_on_page in enumerate(page_boxes):
+            print(f"Running extraction of page{index + 1}")
+            yield pages.get(index), boxes_on_page.extents()
+            pages.release(index)
+
+    snips = encoder.encode(pages_to_encode())
+    uploader = get_snip_uploader()
+    uploaded, skipped = uploader.stats["uploaded"], uploader.stats["skipped"]
+    # upload the snips of the whole document at once, then split the paths per page
+    paths = iter(uploader.save_many([snip for page_snips in snips for snip in page_snips], encoder.extension, encoder.content_type))
+    page_results = [
+        page_snip_paths(extraction, boxes_on_page, [next(paths) for _ in page_snips])
+        for extraction, boxes_on_page, page_snips in zip(extraction_list, page_boxes, snips)
+    ]
+    print(f"Uploaded {uploader.stats['uploaded'] - uploaded} snips, skipped {uploader.stats['skipped'] - skipped} already stored")
+    return group_student_pages(extraction_list, page_results)
+
 import fitz  # PyMuPDF
 from PIL import Image
 
+def render_pdf_page(doc, page_num, dpi=200):
+    """Render a single page of an open PyMuPDF document to a PIL image."""
+    page = doc[page_num]
+    
+    # Render page to a pixmap (bitmap)
+    mat = fitz.Matrix(dpi/72, dpi/72)  # scale for DPI
+    pix = page.get_pixmap(matrix=mat)
+
+    # Convert to PIL Image
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+def pdf_page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
 def pdf_to_images(pdf_path, dpi=200):
     images = []
     doc = fitz.open(pdf_path)
 
     for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # Render page to a pixmap (bitmap)
-        mat = fitz.Matrix(dpi/72, dpi/72)  # scale for DPI
-        pix = page.get_pixmap(matrix=mat)
-
-        # Convert to PIL Image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        images.append(img)
+        images.append(render_pdf_page(doc, page_num, dpi))
 
     return images
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+This module contains the work queue used by the worker mode.
+Producers split documents into page tasks, workers claim tasks and
+write their results back to the queue.
+"""
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import closing
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class Task(BaseModel):
+    task_id: str
+    job_id: str
+    seq: int
+    payload: dict
+    attempts: int = 0
+
+
+class WorkQueue(ABC):
+    """Abstract base class for work queues.
+
+    Any backend (SQLite, Redis, SQS ...) can be plugged into the worker
+    by implementing this interface.
+    """
+
+    @abstractmethod
+    def put(self, job_id: str, seq: int, payload: dict) -> str:
+        """Add a task to the queue and return its task id.
+
+        Args:
+            job_id: id of the job the task belongs to
+            seq: position of the task inside the job, used to order results
+            payload: json serialisable task input
+        """
+        pass
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Optional[Task]:
+        """Claim the next pending task, or None if the queue is empty."""
+        pass
+
+    @abstractmethod
+    def complete(self, task_id: str, worker_id: str, result: dict):
+        """Mark a task as done and store its result.
+        Ignored if the task is no longer claimed by worker_id."""
+        pass
+
+    @abstractmethod
+    def fail(self, task_id: str, worker_id: str, error: str):
+        """Mark a task as failed. It is retried until max attempts is reached.
+        Ignored if the task is no longer claimed by worker_id."""
+        pass
+
+    @abstractmethod
+    def cancel(self, job_id: str):
+        """Mark every pending or running task of a job as failed, so no worker picks it up again.
+        Results of workers still processing a cancelled task are ignored."""
+        pass
+
+    @abstractmethod
+    def job_status(self, job_id: str) -> dict:
+        """Return the number of tasks in each state for a job."""
+        pass
+
+    @abstractmethod
+    def results(self, job_id: str) -> List[dict]:
+        """Return the results of a job ordered by task seq."""
+        pass
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue backed by a SQLite file.
+
+    Workers on one host, or on several hosts sharing the file over a
+    filesystem with working locks, can pull from the same queue.
+    A claimed task that is not completed within `lease_timeout` seconds
+    is handed out again, so a crashed worker does not stall the job.
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_timeout: float = 600.0, max_attempts: int = 3):
+        """
+        Args:
+        path : Path to the SQLite file, defaults to WORK_QUEUE_PATH env variable
+        lease_timeout : Seconds before a claimed task can be claimed again
+        max_attempts : Number of times a task is tried before it is marked failed
+        """
+        path = path or os.environ.get("WORK_QUEUE_PATH")
+        if not path:
+            raise ValueError(
+                "The queue path must be provided either as an argument or via environment variable"
+            )
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id TEXT,
+                    claimed_at REAL,
+                    result TEXT,
+                    error TEXT
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, claimed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, seq)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        return closing(conn)
+
+    def put(self, job_id: str, seq: int, payload: dict) -> str:
+        task_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO tasks (task_id, job_id, seq, payload) VALUES (?, ?, ?, ?)",
+                (task_id, job_id, seq, json.dumps(payload)),
+            )
+        return task_id
+
+    def claim(self, worker_id: str) -> Optional[Task]:
+        now = time.time()
+        with self._connect() as conn:
+            # take the write lock before reading so two workers never claim the same task
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # a task whose lease expired on its last attempt will not be claimed again
+                conn.execute(
+                    """UPDATE tasks SET status = 'failed', error = COALESCE(error, 'lease expired on last attempt')
+                    WHERE status = 'running' AND claimed_at < ? AND attempts >= ?""",
+                    (now - self.lease_timeout, self.max_attempts),
+                )
+                # oldest task first, tasks are inserted in job then seq order
+                row = conn.execute(
+                    """SELECT task_id, job_id, seq, payload, attempts FROM tasks
+                    WHERE status = 'pending' OR (status = 'running' AND claimed_at < ? AND attempts < ?)
+                    ORDER BY rowid LIMIT 1""",
+                    (now - self.lease_timeout, self.max_attempts),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                task_id, job_id, seq, payload, attempts = row
+                conn.execute(
+                    """UPDATE tasks SET status = 'running', worker_id = ?, claimed_at = ?, attempts = attempts + 1
+                    WHERE task_id = ?""",
+                    (worker_id, now, task_id),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return Task(task_id=task_id, job_id=job_id, seq=seq, payload=json.loads(payload), attempts=attempts + 1)
+
+    def complete(self, task_id: str, worker_id: str, result: dict):
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE tasks SET status = 'done', result = ?, error = NULL
+                WHERE task_id = ? AND worker_id = ? AND status = 'running'""",
+                (json.dumps(result), task_id, worker_id),
+            )
+
+    def fail(self, task_id: str, worker_id: str, error: str):
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE tasks SET error = ?,
+                status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END
+                WHERE task_id = ? AND worker_id = ? AND status = 'running'""",
+                (error, self.max_attempts, task_id, worker_id),
+            )
+
+    def cancel(self, job_id: str):
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE tasks SET status = 'failed', error = 'job cancelled'
+                WHERE job_id = ? AND status IN ('pending', 'running')""",
+                (job_id,),
+            )
+
+    def job_status(self, job_id: str) -> dict:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        status = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        status.update(dict(rows))
+        return status
+
+    def results(self, job_id: str) -> List[dict]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT result FROM tasks WHERE job_id = ? AND status = 'done' ORDER BY seq", (job_id,)
+            ).fetchall()
+        return [json.loads(result) for (result,) in rows]
+
@@ -0,0 +1,150 @@
+"""
+Queue backed worker mode for answer extraction.
+
+A producer downloads the pdf and splits it into one task per page, any
+number of worker processes (on one host or many) render, extract, run
+layout and crop the pages, and a reducer groups the page results per
+student once every page of the job is done.
+
+Workers are started with src.services.worker_main.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+import fitz  # PyMuPDF
+import requests
+from config import system_prompts, format_user_prompt
+from .datamodels import SubmitQueryRequest, extraction_structure
+from .answer_extraction import run_structured_inference, run_layout_inference, molmo_inline_images, page_s3_key
+from .utils import save_image_to_s3, crop_page_answers, group_student_pages, render_pdf_page, pdf_page_count
+from .work_queue import WorkQueue
+from dotenv import load_dotenv
+# Load environment variables from .env file
+load_dotenv()
+
+
+def spool_path(job_id: str, spool_dir: str = None) -> str:
+    """Path of the pdf of a job in the spool directory."""
+    spool_dir = spool_dir or os.environ.get("WORK_QUEUE_SPOOL", "/tmp/work_queue_spool")
+    return os.path.join(spool_dir, f"{job_id}.pdf")
+
+
+def submit_job(query: SubmitQueryRequest, queue: WorkQueue, spool_dir: str = None, dpi: int = 200) -> str:
+    """
+    Download the pdf into the spool directory and enqueue one task per page.
+    The spool directory must be reachable by every worker.
+
+    Returns:
+        job id
+    """
+    job_id = uuid.uuid4().hex
+    local_pdf_path = spool_path(job_id, spool_dir)
+    os.makedirs(os.path.dirname(local_pdf_path), exist_ok=True)
+
+    # download the pdf
+    response = requests.get(query.pdf_url_path)
+    with open(local_pdf_path, 'wb') as file:
+        file.write(response.content)
+
+    for page_num in range(pdf_page_count(local_pdf_path)):
+        queue.put(job_id, page_num, {"pdf_path": local_pdf_path, "page_num": page_num, "dpi": dpi})
+    return job_id
+
+
+async def process_page_task(payload: dict) -> dict:
+    """Render, extract, run layout and crop a single page."""
+    with fitz.open(payload["pdf_path"]) as doc:
+        image = render_pdf_page(doc, payload["page_num"], payload["dpi"])
+    image_shape = (image.height, image.width)
+
+    extraction_output = await run_structured_inference(
+        system_prompts["page_extract_prompt"],
+        format_user_prompt("page_extract_prompt"),
+        image,
+        extraction_structure,
+    )
+    if not extraction_output.success:
+        raise RuntimeError(extraction_output.error_message)
+    extraction = extraction_output.structure
+
+    # optionally archive the page while layout runs, without inline images layout uploads it anyway
+    s3_key = page_s3_key(extraction)
+    archive_task = None
+    if molmo_inline_images() and os.environ.get("ARCHIVE_PAGES", "false").lower() == "true":
+        archive_task = asyncio.get_running_loop().run_in_executor(None, save_image_to_s3, image, s3_key)
+
+    prompt = format_user_prompt("molmo_extraction_prompt", question_numbers = extraction["question_numbers"])
+    bbox_output = await run_layout_inference(prompt, image, image_shape, s3_key)
+    if archive_task is not None:
+        await archive_task
+
+    # cropping, encoding and uploading block, keep them off the event loop
+    loop = asyncio.get_running_loop()
+    page_result = await loop.run_in_executor(None, crop_page_answers, extraction, bbox_output, image, image_shape)
+    return {"extraction": extraction, "page_result": page_result}
+
+
+async def run_worker(queue: WorkQueue, worker_id: str = None, poll_interval: float = 1.0, exit_when_idle: bool = False):
+    """Claim and process tasks until stopped (or until the queue is empty with exit_when_idle)."""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    while True:
+        task = queue.claim(worker_id)
+        if task is None:
+            if exit_when_idle:
+                return
+            await asyncio.sleep(poll_interval)
+            continue
+        print(f"[{worker_id}] processing page {task.seq} of job {task.job_id}")
+        try:
+            result = await process_page_task(task.payload)
+        except Exception as e:
+            print(f"[{worker_id}] page {task.seq} of job {task.job_id} failed: {e}")
+            queue.fail(task.task_id, worker_id, str(e))
+        else:
+            queue.complete(task.task_id, worker_id, result)
+
+
+def reduce_job(job_id: str, queue: WorkQueue):
+    """Group the page results of a finished job per student."""
+    results = queue.results(job_id)
+    extraction_list = [result["extraction"] for result in results]
+    page_results = [result["page_result"] for result in results]
+    return group_student_pages(extraction_list, page_results)
+
+
+async def wait_for_job(job_id: str, queue: WorkQueue, poll_interval: float = 2.0, timeout: float = None):
+    """
+    Wait until every page of the job is processed, then reduce it.
+    Raises TimeoutError after timeout seconds (WORK_QUEUE_JOB_TIMEOUT env variable, default 900)
+    so a job without live workers cannot hang the caller.
+    """
+    timeout = timeout or float(os.environ.get("WORK_QUEUE_JOB_TIMEOUT", 900))
+    deadline = time.monotonic() + timeout
+    while True:
+        status = queue.job_status(job_id)
+        if status["pending"] == 0 and status["running"] == 0:
+            break
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout:.0f}s: {status}")
+        await asyncio.sleep(poll_interval)
+    if status["failed"]:
+        raise RuntimeError(f"{status['failed']} page(s) of job {job_id} failed")
+    return reduce_job(job_id, queue)
+
+
+async def answer_extraction_queued(query: SubmitQueryRequest, queue: WorkQueue):
+    """Queue backed equivalent of answer_extraction."""
+    job_id = submit_job(query, queue)
+    print(f"Submitted job {job_id}")
+    try:
+        return await wait_for_job(job_id, queue)
+    except Exception:
+        # stop workers from picking up the remaining pages of a job nobody waits for
+        queue.cancel(job_id)
+        raise
+    finally:
+        # the spooled pdf is no longer needed once the job is reduced or has failed
+        if os.path.exists(spool_path(job_id)):
+            os.remove(spool_path(job_id))
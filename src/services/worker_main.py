@@ -0,0 +1,44 @@
+"""
+Command line entry point for the queue backed workers, kept out of
+src.services.worker so the package can import that module eagerly.
+
+Run workers with:
+    python -m src.services.worker_main --queue /shared/queue.db --processes 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+from .work_queue import SQLiteWorkQueue
+from .worker import run_worker
+
+
+def _worker_process(queue_path: str, poll_interval: float, exit_when_idle: bool):
+    # the worker processes already use every core, encode snips in process
+    os.environ.setdefault("SNIP_ENCODE_PROCESSES", "0")
+    queue = SQLiteWorkQueue(queue_path)
+    asyncio.run(run_worker(queue, poll_interval=poll_interval, exit_when_idle=exit_when_idle))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run answer extraction workers")
+    parser.add_argument("--queue", default=os.environ.get("WORK_QUEUE_PATH"), help="Path to the SQLite queue file")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+    parser.add_argument("--exit-when-idle", action="store_true", help="Exit once the queue is empty")
+    args = parser.parse_args()
+
+    # create the schema once before the workers start
+    SQLiteWorkQueue(args.queue)
+    workers = [
+        multiprocessing.Process(target=_worker_process, args=(args.queue, args.poll_interval, args.exit_when_idle))
+        for _ in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()